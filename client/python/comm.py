@@ -1,64 +1,205 @@
+import asyncio
 import os
 import struct
+import warnings
 
+from google.protobuf.internal import api_implementation
 from proto.usbsas import proto3_pb2 as proto_usbsas
 from proto.common import proto3_pb2 as proto_common
 
+# Default pipe capacity on Linux
+RECV_BUF_SIZE = 65536
+# Messages are prefixed with their size (u64, little endian)
+MSG_SIZE = struct.Struct('<Q')
+
 class Comm(object):
 
     resp_types = {}
     req_types = {}
+    resp_types_rev = {}
+    req_types_rev = {}
     response_cls = None
     request_cls = None
 
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        cls.resp_types_rev = {v: k for k, v in cls.resp_types.items()}
+        cls.req_types_rev = {v: k for k, v in cls.req_types.items()}
+
     def __init__(self, pipe_recv, pipe_send):
         self.pipe_send = pipe_send
         self.pipe_recv = pipe_recv
+        # Reused receive buffer, data between recv_start and recv_end has
+        # been read from the pipe but not consumed yet
+        self.recv_buf = bytearray(RECV_BUF_SIZE)
+        self.recv_start = 0
+        self.recv_end = 0
+        # Outer messages reused for every send, setting a member of their
+        # oneof clears the previous one
+        if self.request_cls is not None:
+            self.request_msg = self.request_cls()
+        if self.response_cls is not None:
+            self.response_msg = self.response_cls()
+        if api_implementation.Type() == "python":
+            warnings.warn(
+                "pure python protobuf implementation in use, (de)serialization "
+                "will be slow (use protobuf >= 4.21 or set "
+                "PROTOCOL_BUFFERS_PYTHON_IMPLEMENTATION)",
+                RuntimeWarning
+            )
+
+    # Read what is available in the pipe, making room for at least size bytes
+    def read_recv_buf(self, size):
+        if self.recv_start + size > len(self.recv_buf):
+            # Move pending bytes to the front and grow the buffer if needed,
+            # it is kept at its high-water mark
+            pending = self.recv_end - self.recv_start
+            self.recv_buf[:pending] = \
+                self.recv_buf[self.recv_start:self.recv_end]
+            self.recv_start, self.recv_end = 0, pending
+            if size > len(self.recv_buf):
+                self.recv_buf.extend(bytes(size - len(self.recv_buf)))
+        # Read as much as available, following messages (status messages
+        # during a copy for instance) are read ahead in the same syscall
+        count = os.readv(self.pipe_recv,
+                         [memoryview(self.recv_buf)[self.recv_end:]])
+        if count == 0:
+            raise EOFError("pipe closed")
+        self.recv_end += count
+
+    # Make sure at least size bytes are buffered
+    def fill_recv_buf(self, size):
+        while self.recv_end - self.recv_start < size:
+            self.read_recv_buf(size)
+
+    async def afill_recv_buf(self, size):
+        while self.recv_end - self.recv_start < size:
+            await self.wait_fd(self.pipe_recv, readable=True)
+            self.read_recv_buf(size)
+
+    # Wait for fd to be readable (or writable) without blocking the event loop
+    async def wait_fd(self, fd, readable):
+        loop = asyncio.get_running_loop()
+        ready = loop.create_future()
+        def set_ready():
+            if not ready.done():
+                ready.set_result(None)
+        if readable:
+            loop.add_reader(fd, set_ready)
+        else:
+            loop.add_writer(fd, set_ready)
+        try:
+            await ready
+        finally:
+            if readable:
+                loop.remove_reader(fd)
+            else:
+                loop.remove_writer(fd)
+
+    def pop_msg_size(self):
+        data_size = MSG_SIZE.unpack_from(self.recv_buf, self.recv_start)[0]
+        self.recv_start += MSG_SIZE.size
+        return data_size
+
+    # The returned view points into the receive buffer, it must be released
+    # before receiving again (the buffer can't be resized while exported)
+    def pop_recv_view(self, size):
+        view = memoryview(self.recv_buf)[
+            self.recv_start:self.recv_start + size]
+        self.recv_start += size
+        if self.recv_start == self.recv_end:
+            self.recv_start = self.recv_end = 0
+        return view
+
+    def recv_view(self):
+        self.fill_recv_buf(MSG_SIZE.size)
+        data_size = self.pop_msg_size()
+        self.fill_recv_buf(data_size)
+        return self.pop_recv_view(data_size)
+
+    async def arecv_view(self):
+        await self.afill_recv_buf(MSG_SIZE.size)
+        data_size = self.pop_msg_size()
+        await self.afill_recv_buf(data_size)
+        return self.pop_recv_view(data_size)
 
     def recv(self):
-        data_size_b = os.read(self.pipe_recv, 8)
-        data_size = struct.unpack('<Q', data_size_b)[0]
-        data = b''
-        while len(data) != data_size:
-            data += os.read(self.pipe_recv, data_size)
-        return data
+        with self.recv_view() as view:
+            return bytes(view)
+
+    async def arecv(self):
+        with await self.arecv_view() as view:
+            return bytes(view)
 
     def send(self, buf):
-        data_size_b = struct.pack('<Q', len(buf))
-        os.write(self.pipe_send, data_size_b)
-        os.write(self.pipe_send, buf)
+        data_size_b = MSG_SIZE.pack(len(buf))
+        # A single writev: atomic up to PIPE_BUF, bigger messages may be
+        # written partially (if interrupted by a signal for instance)
+        count = os.writev(self.pipe_send, [data_size_b, buf])
+        while count < MSG_SIZE.size + len(buf):
+            if count < MSG_SIZE.size:
+                count += os.writev(self.pipe_send,
+                                   [data_size_b[count:], buf])
+            else:
+                count += os.write(self.pipe_send,
+                                  memoryview(buf)[count - MSG_SIZE.size:])
+
+    # The pipe is left in blocking mode: once writable, messages up to
+    # PIPE_BUF are written without blocking, bigger ones may still block
+    async def asend(self, buf):
+        await self.wait_fd(self.pipe_send, readable=False)
+        self.send(buf)
 
     def send_msg(self, msg):
         buf = msg.SerializeToString()
         self.send(buf)
 
-    def recv_resp(self):
-        data = self.recv()
+    def parse_resp_typed(self, data):
         resp = self.response_cls.FromString(data)
         subtype = resp.WhichOneof("msg")
-        cls = self.resp_types.get(subtype)
-        if cls is None:
+        if subtype not in self.resp_types:
             raise TypeError("Unknown response type for %r" % resp)
-        resp = self.response_cls.FromString(data)
-        return getattr(resp, subtype)
+        return subtype, getattr(resp, subtype)
+
+    # Responses and requests are parsed straight from the receive buffer
+    def recv_resp_typed(self):
+        with self.recv_view() as view:
+            return self.parse_resp_typed(view)
+
+    async def arecv_resp_typed(self):
+        with await self.arecv_view() as view:
+            return self.parse_resp_typed(view)
+
+    def recv_resp(self):
+        return self.recv_resp_typed()[1]
 
     def recv_req(self):
-        data = self.recv()
-        req = self.request_cls.FromString(data)
+        with self.recv_view() as view:
+            req = self.request_cls.FromString(view)
         subtype = req.WhichOneof("msg")
         return getattr(req, subtype)
 
     def send_resp(self, resp):
-        type_str = {v:k for k, v in self.resp_types.items()}.get(resp.__class__)
-        if type_str is None:
-            raise TypeError("Unknown response type for %r" % resp)
-        self.send_msg(self.response_cls(**{type_str: resp}))
+        try:
+            type_str = self.resp_types_rev[type(resp)]
+        except KeyError:
+            raise TypeError("Unknown response type for %r" % resp) from None
+        getattr(self.response_msg, type_str).CopyFrom(resp)
+        self.send_msg(self.response_msg)
 
     def send_req(self, req):
-        type_str = {v:k for k, v in self.req_types.items()}.get(req.__class__)
-        if type_str is None:
-            raise TypeError("Unknown request type for %r" % req)
-        self.send_msg(self.request_cls(**{type_str: req}))
+        try:
+            type_str = self.req_types_rev[type(req)]
+        except KeyError:
+            raise TypeError("Unknown request type for %r" % req) from None
+        getattr(self.request_msg, type_str).CopyFrom(req)
+        self.send_msg(self.request_msg)
+
+    # Request / response round trip: one writev and, thanks to the receive
+    # buffer, usually a single readv
+    def call(self, req):
+        self.send_req(req)
+        return self.recv_resp()
 
 
 class CommUsbsas(Comm):
@@ -105,46 +246,37 @@ class CommUsbsas(Comm):
         return isinstance(resp, proto_usbsas.ResponseError)
 
     def get_file_attr(self, path):
-        self.send_req(proto_usbsas.RequestGetAttr(path=path))
-        return self.recv_resp()
+        return self.call(proto_usbsas.RequestGetAttr(path=path))
 
     def end(self):
-        self.send_req(proto_usbsas.RequestEnd())
-        return self.recv_resp()
+        return self.call(proto_usbsas.RequestEnd())
 
     def id(self):
-        self.send_req(proto_usbsas.RequestId())
-        return self.recv_resp()
+        return self.call(proto_usbsas.RequestId())
 
     def devices(self):
-        self.send_req(proto_usbsas.RequestDevices())
-        return self.recv_resp()
+        return self.call(proto_usbsas.RequestDevices())
 
     def open_device(self, busnum, devnum):
-        self.send_req(proto_usbsas.RequestOpenDevice(
+        return self.call(proto_usbsas.RequestOpenDevice(
             device=proto_common.Device(busnum=busnum, devnum=devnum)
             ))
-        return self.recv_resp()
 
     def partitions(self):
-        self.send_req(proto_usbsas.RequestPartitions())
-        return self.recv_resp()
+        return self.call(proto_usbsas.RequestPartitions())
 
     def open_partition(self, index):
-        self.send_req(proto_usbsas.RequestOpenPartition(index=index))
-        return self.recv_resp()
+        return self.call(proto_usbsas.RequestOpenPartition(index=index))
 
     def read_dir(self, path):
-        self.send_req(proto_usbsas.RequestReadDir(path=path))
-        return self.recv_resp()
+        return self.call(proto_usbsas.RequestReadDir(path=path))
 
     def copy_files_usb(self, selected, busnum, devnum):
         req = proto_usbsas.RequestCopyStart(selected=selected)
         req.usb.busnum = busnum
         req.usb.devnum = devnum
         req.usb.fstype = 1 # NTFS
-        self.send_req(req)
-        return self.recv_resp()
+        return self.call(req)
 
     def wipe(self, busnum, devnum, fstype, quick):
         self.send_req(proto_usbsas.RequestWipe(
@@ -152,7 +284,6 @@ class CommUsbsas(Comm):
             ))
 
     def imgdisk(self, busnum, devnum):
-        self.send_req(proto_usbsas.RequestImgDisk(
+        return self.call(proto_usbsas.RequestImgDisk(
             device=proto_common.Device(busnum=busnum, devnum=devnum)
             ))
-        return self.recv_resp()
@@ -11,7 +11,9 @@ flag in execv below)
     usbsas with python and protobuf
 """
 
+import asyncio
 import datetime
+import fcntl
 import os
 import signal
 import struct
@@ -19,13 +21,15 @@ import sys
 import time
 
 from comm import CommUsbsas
-from proto.usbsas import proto3_pb2 as proto_usbsas
 
 usbsas_bin = "/usr/libexec/usbsas-usbsas"
 date = datetime.datetime.now()
 out_tar = "/tmp/usbsas_tmp_%s.tar" % str(date).replace(' ', '_')
 out_fs = "/tmp/usbsas_tmp_%s.fs" % str(date).replace(' ', '_')
 pid_usbsas = -1
+# Bigger pipes let usbsas write large responses (ReadDir of big directories...)
+# in fewer syscalls
+pipe_size = 1 << 20
 
 if not os.path.exists(usbsas_bin):
     usbsas_bin = "../../target/release/usbsas-usbsas"
@@ -38,6 +42,14 @@ def start_usbsas():
     global pid_usbsas
     (child_to_parent_r, child_to_parent_w) = os.pipe()
     (parent_to_child_r, parent_to_child_w) = os.pipe()
+    for fd in (child_to_parent_r, parent_to_child_r):
+        try:
+            # F_SETPIPE_SZ is only defined by fcntl since python 3.10
+            fcntl.fcntl(fd, getattr(fcntl, "F_SETPIPE_SZ", 1031), pipe_size)
+        except OSError:
+            # Above /proc/sys/fs/pipe-max-size without CAP_SYS_RESOURCE,
+            # keep default size
+            pass
     os.set_inheritable(child_to_parent_w, True)
     os.set_inheritable(parent_to_child_r, True)
     with open(out_tar, mode='w'): pass
@@ -87,16 +99,22 @@ def open_dev_and_part(comm, device):
 def list_files(comm):
     rep = comm.read_dir(path="/")
     ok_or_exit(comm, rep, "error listing files")
-    return [f.path for f in rep.filesinfo]
+    # Paths are streamed into the copy request, no list is built
+    return (f.path for f in rep.filesinfo)
 
-def copy(comm, files, device):
+async def copy(comm, files, device):
     rep = comm.copy_files_usb(selected=files, busnum=device.busnum, devnum=device.devnum)
     ok_or_exit(comm, rep, "error starting copy")
     print("Starting copy")
     while True:
-        rep = comm.recv_resp()
-        ok_or_exit(comm, rep, "error during copy")
-        if isinstance(rep, proto_usbsas.ResponseCopyDone):
+        # Status messages are awaited so the event loop can run other tasks
+        # (UI, rendering...) meanwhile. Dispatch on the oneof field name,
+        # cheaper than isinstance checks on protobuf classes.
+        subtype, rep = await comm.arecv_resp_typed()
+        if subtype == "Error":
+            print("error during copy")
+            end(comm)
+        if subtype == "CopyDone":
             print("Transfer done, report:")
             print(rep)
             return
@@ -134,7 +152,7 @@ def main():
     files = list_files(comm)
     comm.id()
     if confirm_copy(devices):
-        copy(comm, files, devices[1])
+        asyncio.run(copy(comm, files, devices[1]))
     end(comm)
     sys.exit(0)
 